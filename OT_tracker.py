@@ -1,9 +1,16 @@
 import streamlit as st
 from openpyxl import load_workbook
 from datetime import date, datetime
+import functools
+import itertools
+import json
 import math
 import os
 import re
+import secrets
+import shutil
+import tempfile
+import threading
 import pandas as pd
 
 # -----------------------------
@@ -11,9 +18,12 @@ import pandas as pd
 # -----------------------------
 FILE_PATH = "OT_Tracker.xlsx"
 SHEET_NAME = "OT"
+ROW_COL = "_excel_row"  # Excel row number kept alongside the mirrored sheet
 
 BILLS_DIR = "Bills"
-BILLS_INDEX = os.path.join(BILLS_DIR, "bills_index.csv")
+BILLS_INDEX = os.path.join(BILLS_DIR, "bills_index.jsonl")
+LEGACY_BILLS_INDEX = os.path.join(BILLS_DIR, "bills_index.csv")
+BILLS_COLUMNS = ["ot_date", "user_name", "file_name", "stored_path", "uploaded_at"]
 
 st.set_page_config(page_title="OT Meal Tracker", layout="wide")
 st.title("OT Meal Tracker")
@@ -21,72 +31,162 @@ st.title("OT Meal Tracker")
 # -----------------------------
 # HELPERS
 # -----------------------------
-def _to_date(x):
-    """Fast conversion to python date (handles datetime/date/strings)."""
-    if x is None:
-        return None
-    if isinstance(x, datetime):
-        return x.date()
-    if isinstance(x, date):
-        return x
+@st.cache_resource(show_spinner=False)
+def _data_versions():
+    """Process-wide write counters shared by all sessions, plus the counter that feeds them."""
+    return {"workbook": 0, "bills": 0}, itertools.count(1)
+
+def get_data_version(name: str) -> int:
+    """Current version of "workbook" or "bills"; used as the cache key instead of a stat() per call."""
+    return _data_versions()[0][name]
+
+def bump_data_version(name: str):
+    """Call after every save/upload so cached reads keyed on the old version go stale."""
+    versions, counter = _data_versions()
+    versions[name] = next(counter)
+
+@st.cache_resource(show_spinner=False)
+def get_write_lock():
+    """One lock for every workbook write in the process (not keyed on version)."""
+    return threading.Lock()
+
+def save_workbook_atomic(wb, file_path: str):
+    """Save to a unique temp file next to file_path, then os.replace it (never leaves a half-written xlsx)."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)) or ".", suffix=".xlsx")
+    os.close(fd)
     try:
-        return datetime.fromisoformat(str(x)).date()
+        wb.save(tmp_path)
+        # mkstemp creates 0600; keep the tracker's existing permissions
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
     except Exception:
-        try:
-            return datetime.strptime(str(x), "%d-%b-%Y").date()
-        except Exception:
-            return None
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-@st.cache_data(show_spinner=False)
-def get_name_to_col(file_path: str, sheet_name: str):
-    """Cache header mapping for speed."""
-    wb = load_workbook(file_path, data_only=True, read_only=True)
-    ws = wb[sheet_name]
+def _header_to_col(header) -> dict:
+    """{name: 1-based Excel column} for the non-empty header cells from column B on."""
     mapping = {}
-    for col in range(2, ws.max_column + 1):
-        name = ws.cell(row=1, column=col).value
-        if name:
+    for col, name in enumerate(list(header)[1:], start=2):
+        if pd.notna(name) and str(name).strip():
             mapping[str(name).strip()] = col
-    wb.close()
     return mapping
 
+@st.cache_data(show_spinner=False)
+def get_name_to_col(file_path: str, sheet_name: str):
+    """Cache header mapping for speed."""
+    header = pd.read_excel(
+        file_path, sheet_name=sheet_name, engine="calamine", header=None, nrows=1, dtype=object, keep_default_na=False,
+    )
+    return {} if header.empty else _header_to_col(header.iloc[0])
+
 @st.cache_data(show_spinner=False)
 def get_all_names(file_path: str, sheet_name: str):
     """Return sorted list of names from header row (B1..)."""
     mapping = get_name_to_col(file_path, sheet_name)
-    return sorted(mapping.keys(), key=lambda x: x.lower())
-
-def find_row_for_date(ws, selected_date: date):
-    """Find the row index in column A matching selected_date."""
-    for idx, (cell_val,) in enumerate(
-        ws.iter_rows(min_row=2, max_row=ws.max_row, min_col=1, max_col=1, values_only=True),
-        start=2,
-    ):
-        if _to_date(cell_val) == selected_date:
-            return idx
-    return None
+    return sorted(mapping.keys(), key=str.lower)
+
+def init_name_state():
+    """Keep the sorted header names (Bills tab choices) in session_state after the first lookup."""
+    if "sorted_names" not in st.session_state:
+        st.session_state.sorted_names = get_all_names(FILE_PATH, SHEET_NAME)
+
+@st.cache_data(show_spinner=False)
+def load_ot_df(file_path: str, sheet_name: str, version: int):
+    """(df, {name: Excel column}) from one parse; df = column-A date index, a column per name + ROW_COL."""
+    with pd.ExcelFile(file_path, engine="calamine") as xls:
+        if sheet_name not in xls.sheet_names:
+            raise KeyError(f"Worksheet {sheet_name} does not exist.")
+        # keep_default_na=False: "NA"/"N/A"/"None" in a claim cell or header is a value, not blank
+        raw = xls.parse(sheet_name, header=None, dtype=object, keep_default_na=False)
+
+    if raw.empty:
+        return pd.DataFrame(columns=[ROW_COL]), {}
+
+    names = _header_to_col(raw.iloc[0])
+    body = raw.iloc[1:]
+    df = body.iloc[:, [col - 1 for col in names.values()]].copy()
+    df.columns = list(names)
+    df.insert(0, ROW_COL, [pos + 2 for pos in range(len(body))])
+
+    # Only datetime/date/string cells can be dates (plain numbers would parse as epoch offsets)
+    vals = [v if isinstance(v, (datetime, date, str)) else None for v in body.iloc[:, 0]]
+    s = pd.Series(vals, dtype=object)
+    # Two fixed-format vectorized passes, same formats as before: ISO dates, then 05-Jan-2024.
+    # ISO8601 alone also takes "2026" / "2026-03", so only values starting with YYYY-MM-DD go to it.
+    iso_src = s.where(s.astype(str).str.match(r"\d{4}-\d{2}-\d{2}"))
+    parsed = pd.to_datetime(iso_src, format="ISO8601", errors="coerce").fillna(
+        pd.to_datetime(s, format="%d-%b-%Y", errors="coerce")
+    )
+    mask = parsed.notna().to_numpy()
+    df = df[mask]
+    df.index = [ts.date() for ts in parsed[mask]]
+    # First row wins for a repeated date
+    return df[~df.index.duplicated()], names
+
+def get_claim_status(df: pd.DataFrame, selected_date: date):
+    """(claimed, unclaimed) name lists for a date from the mirrored sheet; None if the date isn't there."""
+    if selected_date not in df.index:
+        return None
+    row = df.loc[selected_date].drop(ROW_COL)
+    blank = row.isna() | (row == "")
+    return row[~blank].index.tolist(), row[blank].index.tolist()
+
+_UNSAFE_CHARS_RE = re.compile(r"[^\w\-. ]+")   # keep letters/numbers/_ - . space
+_WHITESPACE_RE = re.compile(r"\s+")
 
 def sanitize_filename(s: str) -> str:
     s = str(s).strip()
-    s = re.sub(r"[^\w\-. ]+", "_", s)   # keep letters/numbers/_ - . space
-    s = re.sub(r"\s+", "_", s)
+    s = _UNSAFE_CHARS_RE.sub("_", s)
+    s = _WHITESPACE_RE.sub("_", s)
     return s[:150]
 
+def open_new_bill_file(folder: str, safe_name: str, safe_orig: str):
+    """Atomically create a uniquely named bill file; returns (file object, path)."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    for attempt in range(2):
+        path = os.path.join(folder, f"{safe_name}__{secrets.token_hex(4)}__{safe_orig}")
+        try:
+            fd = os.open(path, flags, 0o644)
+        except FileExistsError:
+            if attempt:
+                raise
+            continue
+        return os.fdopen(fd, "wb"), path
+
+def read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
 def ensure_bills_storage():
     os.makedirs(BILLS_DIR, exist_ok=True)
     if not os.path.exists(BILLS_INDEX):
-        df = pd.DataFrame(columns=["ot_date", "user_name", "file_name", "stored_path", "uploaded_at"])
-        df.to_csv(BILLS_INDEX, index=False)
+        # One-time migration of rows from the old CSV index
+        rows = []
+        if os.path.exists(LEGACY_BILLS_INDEX):
+            try:
+                rows = pd.read_csv(LEGACY_BILLS_INDEX, dtype=str, keep_default_na=False).to_dict("records")
+            except Exception:
+                rows = []
+        with open(BILLS_INDEX, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
 
-def read_bills_index() -> pd.DataFrame:
-    ensure_bills_storage()
+@st.cache_data(show_spinner=False)
+def read_bills_index(version: int) -> pd.DataFrame:
+    """Parse the JSONL bills index; keyed on version so an append invalidates it."""
     try:
-        return pd.read_csv(BILLS_INDEX)
+        df = pd.read_json(BILLS_INDEX, lines=True, dtype=False, convert_dates=False)
     except Exception:
-        return pd.DataFrame(columns=["ot_date", "user_name", "file_name", "stored_path", "uploaded_at"])
+        df = pd.DataFrame()
+    if df.empty:
+        df = pd.DataFrame(columns=BILLS_COLUMNS)
+    # Lowercased categorical copy of user_name so the name filter is an integer compare
+    df["user_name_lc"] = df["user_name"].astype(str).str.lower().astype("category")
+    return df
 
 def append_bill_index(ot_date: date, user_name: str, file_name: str, stored_path: str):
-    df = read_bills_index()
     new_row = {
         "ot_date": ot_date.isoformat(),
         "user_name": user_name,
@@ -94,8 +194,11 @@ def append_bill_index(ot_date: date, user_name: str, file_name: str, stored_path
         "stored_path": stored_path.replace("\\", "/"),
         "uploaded_at": datetime.now().isoformat(timespec="seconds"),
     }
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    df.to_csv(BILLS_INDEX, index=False)
+    # Append-only: one line per bill, no rewrite of the existing index
+    with open(BILLS_INDEX, "a", encoding="utf-8") as f:
+        f.write(json.dumps(new_row) + "\n")
+    read_bills_index.clear()
+    bump_data_version("bills")
 
 # -----------------------------
 # TAB RENDERERS (IMPORTANT: use return, NOT st.stop)
@@ -110,41 +213,33 @@ def render_ot_tab():
         st.info("Please enter a bill amount to continue (other tabs will still work).")
         return
 
+    render_ot_claim_section(selected_date, bill_amount)
+
+@st.fragment
+def render_ot_claim_section(selected_date: date, bill_amount: float):
+    """Bill-dependent part of the OT tab; multiselect/Submit interactions rerun only this fragment."""
     required_people = math.ceil(bill_amount / 750)
 
-    # Load workbook (write mode because we may update)
     try:
-        wb = load_workbook(FILE_PATH)
+        df, names = load_ot_df(FILE_PATH, SHEET_NAME, get_data_version("workbook"))
+    except KeyError:
+        st.error(f"Sheet '{SHEET_NAME}' not found in {FILE_PATH}")
+        return
     except Exception as e:
         st.error(f"Unable to open {FILE_PATH}: {e}")
         return
 
-    if SHEET_NAME not in wb.sheetnames:
-        st.error(f"Sheet '{SHEET_NAME}' not found in {FILE_PATH}")
-        wb.close()
-        return
-
-    ws = wb[SHEET_NAME]
-
-    row_index = find_row_for_date(ws, selected_date)
-    if row_index is None:
+    status = get_claim_status(df, selected_date)
+    if status is None:
         st.error("Date not found in Excel sheet")
-        wb.close()
         return
 
-    names = get_name_to_col(FILE_PATH, SHEET_NAME)
-
-    available_people = []
-    for name, col in names.items():
-        v = ws.cell(row=row_index, column=col).value
-        if v is None or v == "":
-            available_people.append(name)
+    _, available_people = status
 
     st.subheader("People who have NOT claimed OT")
 
     if not available_people:
         st.success("All people have already claimed OT for this date")
-        wb.close()
         return
 
     st.info(f"Bill Amount: ₹{bill_amount:.0f} → You must select **{required_people}** people")
@@ -162,56 +257,55 @@ def render_ot_tab():
     if st.button("Submit OT Claim", key="submit_ot_claim"):
         if required_people > 0 and len(selected_people) != min(required_people, len(available_people)):
             st.error("Please select the required number of people.")
-            wb.close()
             return
 
-        for person in selected_people:
-            ws.cell(row=row_index, column=names[person]).value = "OT"
-
-        try:
-            wb.save(FILE_PATH)
-            st.success("OT Tracker Updated!!")
-            st.info(f"You can Copy names : {'; '.join(selected_people)}")
-        except Exception as e:
-            st.error(f"Failed to save workbook: {e}")
-
-        wb.close()
+        # Columns come from the same parse as the unclaimed list, so they always agree
+        row_index = int(df.at[selected_date, ROW_COL])
+
+        with get_write_lock():
+            # Load under the lock (write mode because we update) so we always patch the latest save
+            try:
+                wb = load_workbook(FILE_PATH)
+            except Exception as e:
+                st.error(f"Unable to open {FILE_PATH}: {e}")
+                return
+
+            ws = wb[SHEET_NAME]
+            for col in sorted(names[person] for person in selected_people):
+                ws.cell(row=row_index, column=col, value="OT")
+
+            try:
+                save_workbook_atomic(wb, FILE_PATH)
+                st.success("OT Tracker Updated!!")
+                st.info(f"You can Copy names : {'; '.join(selected_people)}")
+            except Exception as e:
+                st.error(f"Failed to save workbook: {e}")
+
+            # Drop the sheet mirror so the next rerun re-reads the saved file
+            load_ot_df.clear()
+            bump_data_version("workbook")
         return
 
-    wb.close()
-
 def render_names_finder_tab():
     st.subheader("Names Finder")
 
     nf_date = st.date_input("Select Date", value=date.today(), key="nf_date")
 
     try:
-        wb = load_workbook(FILE_PATH, data_only=True)
+        df, _ = load_ot_df(FILE_PATH, SHEET_NAME, get_data_version("workbook"))
+    except KeyError:
+        st.error(f"Sheet '{SHEET_NAME}' not found in {FILE_PATH}")
+        return
     except Exception as e:
         st.error(f"Unable to open {FILE_PATH}: {e}")
         return
 
-    if SHEET_NAME not in wb.sheetnames:
-        st.error(f"Sheet '{SHEET_NAME}' not found in {FILE_PATH}")
-        wb.close()
-        return
-
-    ws = wb[SHEET_NAME]
-    row_index = find_row_for_date(ws, nf_date)
-    if row_index is None:
+    status = get_claim_status(df, nf_date)
+    if status is None:
         st.error("Date not found in Excel sheet")
-        wb.close()
         return
 
-    names = get_name_to_col(FILE_PATH, SHEET_NAME)
-
-    claimed, unclaimed = [], []
-    for name, col in names.items():
-        v = ws.cell(row=row_index, column=col).value
-        if v is None or v == "":
-            unclaimed.append(name)
-        else:
-            claimed.append(name)
+    claimed, unclaimed = status
 
     c1, c2 = st.columns(2)
     with c1:
@@ -221,21 +315,9 @@ def render_names_finder_tab():
         st.markdown("### ⬜ Not Claimed")
         st.write(unclaimed if unclaimed else "Everyone has claimed.")
 
-    wb.close()
-
-def render_bills_repo_tab():
-    st.subheader("Bills Repo")
-
-    ensure_bills_storage()
-    df = read_bills_index()
-
-    # Load names from Excel header for recommendations
-    all_names = get_all_names(FILE_PATH, SHEET_NAME)
-    all_names = [name for name in all_names if name != "Day"]  
-    if not all_names:
-        st.error("No names found in Excel header row (Row 1, from Column B onwards).")
-        return
-
+@st.fragment
+def render_bills_find_section(df: pd.DataFrame, all_names: list):
+    """Bill search/download list; changing the filter reruns only this fragment."""
     # -------- Find bills --------
     st.markdown("### Find Previously Uploaded Bills")
 
@@ -251,29 +333,45 @@ def render_bills_repo_tab():
             key="bill_filter_name_select"
         )
 
-    df_view = df.copy()
+    df_view = df
     if not df_view.empty:
         if filter_name != "All":
-            df_view = df_view[df_view["user_name"].astype(str).str.lower() == filter_name.lower()]
+            df_view = df_view[df_view["user_name_lc"] == filter_name.lower()]
 
     if df_view.empty:
         st.info("No bills found for the selected filter.")
     else:
-        st.dataframe(df_view.sort_values(by="uploaded_at", ascending=False), use_container_width=True)
+        df_view = df_view.sort_values(by="uploaded_at", ascending=False)
+        st.dataframe(df_view.drop(columns="user_name_lc"), width="stretch")
 
-        # Optional: download buttons
+        # Optional: download buttons (file bytes are read only when a button is clicked)
         st.markdown("#### Download (latest 10 shown)")
-        for i, row in df_view.sort_values(by="uploaded_at", ascending=False).head(10).iterrows():
+        for i, row in df_view.head(10).iterrows():
             path = str(row["stored_path"])
             if os.path.exists(path):
-                with open(path, "rb") as f:
-                    st.download_button(
-                        label=f"Download: {row['file_name']} ({row['user_name']} - {row['ot_date']})",
-                        data=f,
-                        file_name=os.path.basename(path),
-                        mime="application/octet-stream",
-                        key=f"dl_{i}"
-                    )
+                st.download_button(
+                    label=f"Download: {row['file_name']} ({row['user_name']} - {row['ot_date']})",
+                    data=functools.partial(read_file_bytes, path),
+                    file_name=os.path.basename(path),
+                    mime="application/octet-stream",
+                    key=f"dl_{i}"
+                )
+
+def render_bills_repo_tab():
+    st.subheader("Bills Repo")
+
+    ensure_bills_storage()
+    df = read_bills_index(get_data_version("bills"))
+
+    # Load names from Excel header for recommendations
+    init_name_state()
+    all_names = st.session_state.sorted_names
+    all_names = [name for name in all_names if name != "Day"]  
+    if not all_names:
+        st.error("No names found in Excel header row (Row 1, from Column B onwards).")
+        return
+
+    render_bills_find_section(df, all_names)
 
     st.divider()
 
@@ -301,24 +399,17 @@ def render_bills_repo_tab():
         safe_name = sanitize_filename(upload_name)
         safe_orig = sanitize_filename(uploaded_file.name)
 
-        # Store in Bills/YYYY-MM-DD/username__originalname.ext
+        # Store in Bills/YYYY-MM-DD/username__<random>__originalname.ext
         date_folder = os.path.join(BILLS_DIR, upload_date.isoformat())
         os.makedirs(date_folder, exist_ok=True)
 
-        stored_filename = f"{safe_name}__{safe_orig}"
-        stored_path = os.path.join(date_folder, stored_filename)
-
-        # Avoid overwrite by adding counter
-        base, ext = os.path.splitext(stored_filename)
-        counter = 1
-        while os.path.exists(stored_path):
-            stored_filename = f"{base}__{counter}{ext}"
-            stored_path = os.path.join(date_folder, stored_filename)
-            counter += 1
-
         try:
-            with open(stored_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
+            f, stored_path = open_new_bill_file(date_folder, safe_name, safe_orig)
+            with f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                uploaded_file.seek(0)
+                shutil.copyfileobj(uploaded_file, f, length=1024 * 1024)
 
             append_bill_index(upload_date, upload_name, uploaded_file.name, stored_path)
 